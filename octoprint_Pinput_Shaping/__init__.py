@@ -4,27 +4,112 @@ Perform input shaping tests on 3D printers using a accelerometers
 
 from __future__ import absolute_import
 
-import csv
-import inspect
+import concurrent.futures
+import functools
 import json
 import logging
 import os
+import pty
 import re
+import subprocess
+import sys
 import threading
 import time
+import types
 
 import flask
 import numpy as np
 import octoprint.filemanager
 import octoprint.filemanager.util
 import octoprint.plugin
-import pexpect
 from octoprint.logging.handlers import CleaningTimedRotatingFileHandler
-
-from .inputshaping_analyzer import InputShapingAnalyzer
+from scipy.signal import chirp
+
+from .inputshaping_analyzer import InputShapingAnalyzer, load_csv_columns
+
+# M593 report line, e.g. "echo:  M593 X F40.00 D0.15"
+_RE_M593 = re.compile(r"M593 ([XY]) F([\d.]+) D([\d.]+)")
+# Prefix of every M118 message the plugin sends to itself through the printer
+_MARKER_PREFIX = "Pinput_Shaping: "
+# Capture tool confirmation once the CSV has been written
+_RE_SAVED = re.compile(r"Saved .* samples")
+# Capture CSV columns, in the order the accelerometer test returns them
+_CAPTURE_COLUMNS = ("time", "x", "y", "z")
+
+# Plugin settings with their log label and the type they are used as
+_SETTINGS_SPEC = {
+    "sizeX": ("X size", float),
+    "sizeY": ("Y size", float),
+    "sizeZ": ("Z size", float),
+    "accelMin": ("Acceleration min", int),
+    "accelMax": ("Acceleration max", int),
+    "freqStart": ("Frequency start", float),
+    "freqEnd": ("Frequency end", float),
+    "dampingRatio": ("Damping ratio", float),
+    "sensorType": ("Sensor type", str),
+}
+
+
+def _build_cycle_arrays(num_cycles, steps_per_cycle, amplitude, min_amp, accel_min, accel_max) -> tuple:
+    """Numeric core of the resonance sweep.
+
+    Returns the per-move axis offsets and feedrates, the per-cycle integer
+    accelerations and a per-cycle mask of where a new M204 has to be sent.
+    """
+
+    amplitudes = np.linspace(amplitude, min_amp, num_cycles, dtype=np.float32)
+    accelerations = np.linspace(accel_min, accel_max, num_cycles, dtype=np.float32)
+    feedrates = np.clip(100 * accelerations, 2000, 15000)
+
+    # One row per cycle, one column per step
+    phase_sin = np.sin(
+        2 * np.pi * np.arange(steps_per_cycle, dtype=np.float32) / steps_per_cycle
+    )
+    offsets = (amplitudes[:, None] * phase_sin[None, :]).ravel()
+    feeds = np.repeat(feedrates.astype(int), steps_per_cycle)
+
+    # Cycles where the acceleration drifted more than 100 mm/s² from the last M204 sent
+    accels = accelerations.astype(int)
+    accel_changes = np.zeros(num_cycles, dtype=bool)
+    current_accel = accels[0]
+    for i, accel in enumerate(accels.tolist()):
+        if abs(accel - current_accel) > 100:
+            accel_changes[i] = True
+            current_accel = accel
+
+    return offsets, accels, feeds, accel_changes
+
+
+def _pass_through_mask(offsets, feeds):
+    """Mask of the waypoints worth sending.
+
+    A waypoint that lies strictly between its neighbours, with the same feed on
+    both sides, is on a straight line the planner would run through at full
+    speed anyway, so dropping it leaves the motion unchanged and saves a line.
+    """
+
+    keep = np.ones(len(offsets), dtype=bool)
+    if len(offsets) > 2:
+        prev_step = offsets[1:-1] - offsets[:-2]
+        next_step = offsets[2:] - offsets[1:-1]
+        keep[1:-1] = ~((prev_step * next_step > 0) & (feeds[1:-1] == feeds[2:]))
+    return keep
+
+
+def _ensure_dir(path, mode=0o775) -> None:
+    """Create a directory if needed and only chmod it when its mode differs."""
+
+    os.makedirs(path, mode=mode, exist_ok=True)
+    if os.stat(path).st_mode & 0o777 != mode:
+        try:
+            os.chmod(path, mode)
+        except PermissionError:
+            # Existing directory owned by someone else, usable as it is
+            pass
 
 
 class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
+                          octoprint.plugin.ShutdownPlugin,
                           octoprint.filemanager.util.LineProcessorStream,
                           octoprint.plugin.EventHandlerPlugin,
                           octoprint.plugin.ProgressPlugin,
@@ -53,11 +138,28 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
         self.accelerometer_capture_active = False
         self.last_command_sent = ""
         self._adchild = None
+        self._adchild_fd = None
+        self._adchild_reader = None
+        self._adchild_ready = threading.Event()
+        self._adchild_saved = threading.Event()
+        self._adchild_exited = threading.Event()
         self._adchild_logfile = None
         self._adchild_logfilename = None
         self.currentAxis = None
         self.shapers = None
         self.getM593 = False
+        self._active = False  # a sweep is queued and its markers are still expected
+        self._m593_ready = threading.Event()  # set once the M593 report is backed up
+        self._last_shaper_bytes = None  # contents of the last backup written
+        # Keeps capture teardown and FFT analysis off the serial reader thread
+        self._analysis_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # Plugin M118 messages keyed by their first word, with the method reacting to each
+        self._received_markers = {
+            "Store": ("Store shapers", self._on_store_shapers),
+            "Resonance": ("Resonance Test complete", self._on_resonance_complete),
+            "Finish": ("Finish Test Sweep", self._on_finish_sweep),
+            "Accelerometer|ON": ("Accelerometer|ON", self._on_accelerometer_on),
+        }
 
         self._plugin_logger = logging.getLogger("octoprint.plugins.Pinput_Shaping")
 
@@ -72,6 +174,10 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
             os.chmod(log_base_path, 0o775)
 
         log_file_path = os.path.join(log_base_path, "Pinput_Shaping.log")
+        # The logger is module global, don't stack a second file handler on it
+        if any(getattr(h, "baseFilename", None) == log_file_path
+               for h in self._plugin_logger.handlers):
+            return
         handler = CleaningTimedRotatingFileHandler(
             log_file_path, when="D", backupCount=3)
         handler.setFormatter(logging.Formatter(
@@ -83,7 +189,50 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
     def get_current_function_name(self) -> str:
         """Get the name of the current function."""
 
-        return inspect.getframeinfo(inspect.currentframe().f_back).function
+        return sys._getframe(1).f_code.co_name
+
+    def _snapshot_settings(self) -> types.SimpleNamespace:
+        """Read all plugin settings in one go, as stored, for the settings log dumps."""
+
+        return types.SimpleNamespace(**{
+            key: self._settings.get([key]) for key in _SETTINGS_SPEC
+        })
+
+    def _typed_settings(self, *keys) -> tuple:
+        """Read the given settings, converted to the type they are used as.
+        :raises ValueError: Naming the setting whose stored value can't be converted.
+        """
+
+        values = []
+        for key in keys:
+            label, cast = _SETTINGS_SPEC[key]
+            raw = self._settings.get([key])
+            try:
+                values.append(cast(raw))
+            except (TypeError, ValueError):
+                raise ValueError(
+                    f"Invalid {label} setting: {raw!r} (expected {cast.__name__})"
+                ) from None
+        return tuple(values)
+
+    def _settings_error(self, error) -> dict:
+        """Report a setting that can't be used to the UI and return the failed API result."""
+
+        message = f"{error}. Please fix it in the plugin settings."
+        self._plugin_manager.send_plugin_message(
+            self._identifier, dict(type="close_popup")
+        )
+        self._plugin_manager.send_plugin_message(
+            self._identifier, {"type": "error_popup", "message": message}
+        )
+        self._plugin_logger.error(message)
+        return {"success": False, "error": message}
+
+    def _log_settings(self, settings) -> None:
+        """Log a settings snapshot, one labelled line per setting."""
+
+        for key, (label, _) in _SETTINGS_SPEC.items():
+            self._plugin_logger.info("%s: %s", label, getattr(settings, key))
 
     def get_settings_defaults(self) -> dict:
         """Return the default settings for the plugin."""
@@ -129,17 +278,9 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
 
         self.configure_logger()
         self._plugin_logger.info(">>>>>> PInput-Shaping Loaded <<<<<<")
-        self._plugin_logger.info(f"Plugin identifier is: {self._identifier}")
-        self._plugin_logger.info(f"Plugin version is: {self._plugin_version}")
-        self._plugin_logger.info(f"X size: {self._settings.get(['sizeX'])}")
-        self._plugin_logger.info(f"Y size: {self._settings.get(['sizeY'])}")
-        self._plugin_logger.info(f"Z size: {self._settings.get(['sizeZ'])}")
-        self._plugin_logger.info(f"Acceleration min: {self._settings.get(['accelMin'])}")
-        self._plugin_logger.info(f"Acceleration max: {self._settings.get(['accelMax'])}")
-        self._plugin_logger.info(f"Frequency start: {self._settings.get(['freqStart'])}")
-        self._plugin_logger.info(f"Frequency end: {self._settings.get(['freqEnd'])}")
-        self._plugin_logger.info(f"Damping ratio: {self._settings.get(['dampingRatio'])}")
-        self._plugin_logger.info(f"Sensor type: {self._settings.get(['sensorType'])}")
+        self._plugin_logger.info("Plugin identifier is: %s", self._identifier)
+        self._plugin_logger.info("Plugin version is: %s", self._plugin_version)
+        self._log_settings(self._snapshot_settings())
 
         self._plugin_manager.send_plugin_message(
             self._identifier, {"msg": "Pinput Shaping Plugin loaded"}
@@ -155,15 +296,19 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
         )
 
         # Create the directory if it doesn't exist
-        os.makedirs(self.metadata_dir, exist_ok=True)
-        os.chmod(self.metadata_dir, 0o775)
-        os.makedirs(self.graphs_dir, exist_ok=True)
-        os.chmod(self.graphs_dir, 0o775)
+        _ensure_dir(self.metadata_dir)
+        _ensure_dir(self.graphs_dir)
 
         self._plugin_logger.info(
-            f">>>>>> PInput-Shaping Metadata directory initialized: {self.metadata_dir}")
+            ">>>>>> PInput-Shaping Metadata directory initialized: %s", self.metadata_dir)
         self._plugin_logger.info(
-            f">>>>>> PInput-Shaping Graphs directory initialized: {self.graphs_dir}")
+            ">>>>>> PInput-Shaping Graphs directory initialized: %s", self.graphs_dir)
+
+    def on_shutdown(self) -> None:
+        """Called when OctoPrint shuts down."""
+
+        # Drop queued worker jobs and do not wait here for the one still running
+        self._analysis_pool.shutdown(wait=False, cancel_futures=True)
 
     def get_api_commands(self) -> dict:
         """Return the API commands for the plugin."""
@@ -176,7 +321,7 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
         """Handle API commands sent to the plugin."""
 
         self._plugin_logger.info(
-            f">>>>>> PInput-Shaping API Command: {command} with data: {data}")
+            ">>>>>> PInput-Shaping API Command: %s with data: %s", command, data)
         if command == "run_accelerometer_test":
             self._plugin_manager.send_plugin_message(
                 self._identifier,
@@ -187,7 +332,7 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
 
         if command == "run_axis_test":
             axis = data["data"]["axis"]
-            self._plugin_logger.info(f"Triggering axis {axis} test")
+            self._plugin_logger.info("Triggering axis %s test", axis)
             self._plugin_manager.send_plugin_message(
                 self._identifier,
                 {"type": "popup", "message": f"Running Test for {axis} Axis..."},
@@ -199,7 +344,7 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
             x = data["data"]["start_x"]
             y = data["data"]["start_y"]
             z = data["data"]["start_z"]
-            self._plugin_logger.info(f"Triggering resonance test for axis {axis}")
+            self._plugin_logger.info("Triggering resonance test for axis %s", axis)
             self._plugin_manager.send_plugin_message(
                 self._identifier,
                 {
@@ -210,22 +355,14 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
             result = self._run_resonance_test(axis, x, y, z)
             return flask.jsonify(result)
 
-        self._plugin_logger.warning(f"Unknown API command: {command}")
+        self._plugin_logger.warning("Unknown API command: %s", command)
         return flask.jsonify({"success": False, "error": "Unknown command"})
 
     def _run_accelerometer_test(self) -> dict:
         """Run the accelerometer test and return the results."""
 
         self._plugin_logger.info(">>>>>>> Running accelerometer test with settings:")
-        self._plugin_logger.info(f"X size: {self._settings.get(['sizeX'])}")
-        self._plugin_logger.info(f"Y size: {self._settings.get(['sizeY'])}")
-        self._plugin_logger.info(f"Z size: {self._settings.get(['sizeZ'])}")
-        self._plugin_logger.info(f"Acceleration min: {self._settings.get(['accelMin'])}")
-        self._plugin_logger.info(f"Acceleration max: {self._settings.get(['accelMax'])}")
-        self._plugin_logger.info(f"Frequency start: {self._settings.get(['freqStart'])}")
-        self._plugin_logger.info(f"Frequency end: {self._settings.get(['freqEnd'])}")
-        self._plugin_logger.info(f"Damping ratio: {self._settings.get(['dampingRatio'])}")
-        self._plugin_logger.info(f"Sensor type: {self._settings.get(['sensorType'])}")
+        self._log_settings(self._snapshot_settings())
 
         try:
             self.csv_filename = os.path.join(self.metadata_dir, "accelerometer_test_capture.csv")
@@ -246,31 +383,19 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
                 )
                 return {"success": False, "error": my_err}
 
-            samples = []
-            with open(self.csv_filename, "r", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    samples.append({
-                        "time": row["time"],
-                        "x": row["x"],
-                        "y": row["y"],
-                        "z": row["z"]
-                    })
+            data = load_csv_columns(self.csv_filename, _CAPTURE_COLUMNS)
+            samples = [
+                {"time": t, "x": x, "y": y, "z": z} for t, x, y, z in data.tolist()
+            ]
 
             summary_line = "No summary available"
             if os.path.exists(log_filename):
-                with open(log_filename, "r", encoding="utf-8") as logf:
-                    lines = logf.read().strip().splitlines()
-                    for line in reversed(lines):
-                        if "samples" in line and "Hz" in line:
-                            summary_line = line
-                            break
+                summary_line = self._find_log_summary(log_filename) or summary_line
             else:
                 self._plugin_logger.warning("Output log not found")
 
             self._plugin_logger.info(
-                f"Accelerometer test completed. Summary: {summary_line}"
-            )
+                "Accelerometer test completed. Summary: %s", summary_line)
             self._plugin_manager.send_plugin_message(
                 self._identifier, dict(type="close_popup")
             )
@@ -279,21 +404,43 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
                 "summary": summary_line,
                 "samples": samples,
                 "stdout_preview": "\n".join(
-                    [f"{s['time']} {s['x']} {s['y']} {s['z']}" for s in samples[-5:]]
+                    " ".join(f"{v:.6g}" for v in row) for row in data[-5:].tolist()
                 )  # last few samples
             }
 
         except Exception as e:
-            self._plugin_logger.error(f"Accelerometer test failed: {e}")
+            self._plugin_logger.error("Accelerometer test failed: %s", e)
             self._plugin_manager.send_plugin_message(
                 self._identifier, {"type": "error_popup", "message": str(e)}
             )
             return {"success": False, "error": str(e)}
 
+    def _find_log_summary(self, path) -> str:
+        """Return the last "... samples ... Hz" line of a capture log, or "" if there is none.
+
+        The summary is printed on exit, so the log is read backwards in 4 KiB
+        blocks and scanning stops at the first match.
+        """
+
+        with open(path, "rb") as logf:
+            pos = logf.seek(0, os.SEEK_END)
+            partial = b""
+            while pos > 0:
+                size = min(4096, pos)
+                pos -= size
+                logf.seek(pos)
+                lines = (logf.read(size) + partial).split(b"\n")
+                # Unless we reached the start, the first piece may be cut mid-line
+                partial = lines.pop(0) if pos else b""
+                for line in reversed(lines):
+                    if b"samples" in line and b"Hz" in line:
+                        return line.decode("utf-8", errors="replace").strip()
+        return ""
+
     def _run_axis_test(self, axis) -> dict:
         """Run the axis test for the specified axis."""
 
-        self._plugin_logger.info(f">>>>>> Running Sweeping {axis} test")
+        self._plugin_logger.info(">>>>>> Running Sweeping %s test", axis)
         # create variable with the value of datetime in iso format
         dt = time.strftime("%Y%m%dT%H%M%S")
         self.csv_filename = os.path.join(
@@ -304,12 +451,16 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
 
         if printer_status == "OPERATIONAL":
             self._plugin_logger.info("Printer is idle. Proceeding with Axis test.")
+            try:
+                size_x, size_y = self._typed_settings("sizeX", "sizeY")
+            except ValueError as e:
+                return self._settings_error(e)
             self._plugin_logger.info("Sending precomputed commands to printer...")
-            x = float(self._settings.get(["sizeX"])) / 2
-            y = float(self._settings.get(["sizeY"])) / 2
+            self._active = True
+            x = size_x / 2
+            y = size_y / 2
             z = 10  # Default Z height for parking
-            self.home_and_park(x, y, z)
-            self._printer.commands(self.test_sweep(axis))
+            self.home_and_park(x, y, z, self.test_sweep(axis))
             return {
                 "success": True,
                 "summary": f"Test for {axis} triggered successfully."
@@ -328,7 +479,7 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
     def _run_resonance_test(self, axis, x, y, z) -> dict:
         """Run the resonance test for the specified axis at given coordinates."""
 
-        self._plugin_logger.info(f"Running resonance test for {axis} axis at position ({x}, {y}, {z})")
+        self._plugin_logger.info("Running resonance test for %s axis at position (%s, %s, %s)", axis, x, y, z)
          #create variable with the value of datetime in iso format
         dt= time.strftime("%Y%m%dT%H%M%S")
         self.csv_filename = os.path.join(self.metadata_dir, f"Raw_accel_values_AXIS_{axis}_{dt}.csv")
@@ -337,13 +488,21 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
 
         if printer_status == "OPERATIONAL":
             self._plugin_logger.info("Printer is idle. Proceeding with resonance test.")
+            # Built first so a bad setting fails the test before anything is sent
+            try:
+                sweep = self.precompute_sweep(axis, x, y)
+            except ValueError as e:
+                return self._settings_error(e)
             self.accelerometer_capture_active = True
-            self._printer.commands("M118 Pinput_Shaping: Store shapers")
-            self._printer.commands("M593")
-            time.sleep(2)
+            self._active = True
+            self._m593_ready.clear()
+            self._printer.commands(["M118 Pinput_Shaping: Store shapers", "M593"])
+            # Returns as soon as the M593 report has been backed up
+            if not self._m593_ready.wait(timeout=5):
+                self._plugin_logger.warning(
+                    "No M593 report within 5s, starting the sweep without waiting for the backup")
             self._plugin_logger.info("Sending resonance test commands to printer...")
-            self.home_and_park(x, y, z)
-            self._printer.commands(self.precompute_sweep(axis, x, y))
+            self.home_and_park(x, y, z, sweep)
             return {
                 "success": True,
                 "summary": f"Resonance test for {axis} triggered successfully."
@@ -364,22 +523,38 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
         """Precompute the sweep commands for the specified axis."""
 
         self.currentAxis = axis
-        self._plugin_logger.info(f"Precomputing sweep commands for Axis {axis}...")
-        t = np.linspace(0, self.DURATION, num=2000)  # 2000 points over 20 seconds
-        freqs = self.FREQ_START + (self.FREQ_END - self.FREQ_START) * t / self.DURATION
-        positions = self.START_POS + self.AMPLITUDE * np.sin(2 * np.pi * freqs * t)
-        commands = []
-        commands.append(f"M117 Testing Sweep on {axis}-Axis")
-        for pos in positions:
-            commands.append(f"G0 {axis}{pos} F{60 * self.ACCELERATION}")
-
-        commands.append(f"M117 Finish Test Sweep on {axis}-Axis")
-        commands.append(f"M118 Pinput_Shaping: Finish Test Sweep on {axis}-Axis")
-
-        return commands
+        self._plugin_logger.info("Precomputing sweep commands for Axis %s...", axis)
+        return list(self._build_sweep_commands(
+            axis, self.FREQ_START, self.FREQ_END, self.DURATION,
+            self.AMPLITUDE, self.START_POS, self.ACCELERATION,
+        ))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=8)
+    def _build_sweep_commands(axis, freq_start, freq_end, duration, amplitude, start_pos, acceleration) -> tuple:
+        """Build the sweep commands, cached since the parameters rarely change between runs."""
+
+        # float32 is plenty for sub-micron positions and halves the array traffic
+        t = np.linspace(0, duration, num=2000, dtype=np.float32)  # 2000 points over 20 seconds
+        # Linear chirp from freq_start to freq_end; phi=-90 makes it a sine that starts at start_pos
+        positions = start_pos + amplitude * chirp(
+            t, f0=freq_start, t1=duration, f1=freq_end, method="linear", phi=-90
+        )
+        feed = 60 * acceleration
+        # Three decimals is already finer than any printer's step resolution
+        moves = np.char.mod(f"G0 {axis}%.3f F{feed}", positions).tolist()
+
+        return (
+            f"M117 Testing Sweep on {axis}-Axis",
+            *moves,
+            f"M117 Finish Test Sweep on {axis}-Axis",
+            f"M118 Pinput_Shaping: Finish Test Sweep on {axis}-Axis",
+        )
 
     def precompute_sweep(self, axis, x, y) -> list:
-        """Precompute the resonance test commands for the specified axis."""
+        """Precompute the resonance test commands for the specified axis.
+        :raises ValueError: If the acceleration settings aren't integers.
+        """
 
         num_cycles = 800
         steps_per_cycle = 4
@@ -388,46 +563,48 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
         min_amp = 1
         self.currentAxis = axis
 
-        accel_min = int(self._settings.get(["accelMin"]))
-        accel_max = int(self._settings.get(["accelMax"]))
+        accel_min, accel_max = self._typed_settings("accelMin", "accelMax")
         # freq_start = float(self._settings.get(["freqStart"]))
         # freq_end = float(self._settings.get(["freqEnd"]))
 
-        # freqs = np.linspace(freq_start, freq_end, num_cycles)
-        amplitudes = np.linspace(amplitude, min_amp, num_cycles)
-        accelerations = np.linspace(accel_min, accel_max, num_cycles)
-        feedrates = np.clip(100 * accelerations, 2000, 15000)
+        offsets, accels, feeds, accel_changes = _build_cycle_arrays(
+            num_cycles, steps_per_cycle, amplitude, min_amp, accel_min, accel_max
+        )
 
         commands = []
         commands.append("M117 Starting resonance test")
         commands.append("M118 Pinput_Shaping: Accelerometer|ON")
         commands.append("M593 F0")
         commands.append(f"M117 Resonance Test on {axis}-Axis")
+        commands.append(f"M204 S{accels[0]}")
 
-        current_accel = int(accelerations[0])
-        commands.append(f"M204 S{current_accel}")
-
-        for i in range(num_cycles):
-            # freq = freqs[i]
-            amp = amplitudes[i]
-            accel = int(accelerations[i])
-            feed = int(feedrates[i])
-
-            # if int(freq) % 10 == 0:
-            #    commands.append(f"M117 {axis} {int(freq)}Hz /{accel}mm/s²")
-
-            if abs(accel - current_accel) > 100:
-                commands.append(f"M204 S{accel}")
-                current_accel = accel
-
-            for j in range(steps_per_cycle):
-                phase = 2 * np.pi * j / steps_per_cycle
-                offset = amp * np.sin(phase)
-
-                if axis == "X":
-                    commands.append(f"G0 X{x + offset:.3f} Y{y:.3f} F{feed}")
-                elif axis == "Y":
-                    commands.append(f"G0 X{x:.3f} Y{y + offset:.3f} F{feed}")
+        if axis == "X":
+            moves = np.char.add(
+                np.char.mod("G0 X%.3f", x + offsets),
+                np.char.mod(f" Y{y:.3f} F%d", feeds),
+            )
+        elif axis == "Y":
+            moves = np.char.add(
+                np.char.mod(f"G0 X{x:.3f} Y%.3f", y + offsets),
+                np.char.mod(" F%d", feeds),
+            )
+        else:
+            moves = np.array([], dtype=str)
+
+        if moves.size:
+            # The zero crossings sit midway between two turning points, skip them
+            keep = _pass_through_mask(offsets, feeds)
+            moves = moves[keep]
+            # Splice each M204 in front of the first move sent for its cycle
+            change_cycles = np.flatnonzero(accel_changes)
+            kept_before = np.concatenate(([0], np.cumsum(keep)))
+            accel_cmds = np.char.mod("M204 S%d", accels[change_cycles])
+            moves = np.insert(
+                moves.astype(np.promote_types(moves.dtype, accel_cmds.dtype), copy=False),
+                kept_before[change_cycles * steps_per_cycle],
+                accel_cmds,
+            )
+        commands.extend(moves.tolist())
 
         commands.append("M118 Pinput_Shaping: Resonance Test complete")
         commands.append("M204 P1500 R500 T1500")  # restoring original accel
@@ -435,14 +612,14 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
 
         return commands
 
-    def home_and_park(self, x, y, z) -> None:
-        """Home and park the printer at the specified coordinates."""
+    def home_and_park(self, x, y, z, commands=()) -> None:
+        """Home and park the printer at the specified coordinates.
+        Any extra commands are queued in the same batch right after parking.
+        """
 
         self._plugin_logger.info("Homing and parking printer...")
         start_pos = f"X{x} Y{y} Z{z}"
-        self._printer.commands("G28")
-        self._printer.commands(f"G0 {start_pos} F1500")
-        self._printer.commands("G4 P1000")
+        self._printer.commands(["G28", f"G0 {start_pos} F1500", "G4 P1000", *commands])
 
     # def gcode_sending_handler(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
     #     #self._plugin_logger.info(f"Intercepted G-code: {cmd}")
@@ -460,66 +637,112 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
     def gcode_received_handler(self, comm, line, *args, **kwargs) -> str:
         """Handle received G-code lines and process Input Shaping commands."""
 
-        if "Pinput_Shaping: Store shapers" in line:
-            self._plugin_logger.info("Detected M118: Store shapers message")
-            self.getM593 = True
-            self.shapers = {}
+        # Nothing to look for unless one of our sweeps is running
+        if not self._active and not self.getM593:
+            return line
+
+        # Only our own M118 echoes and M593 reports are of interest
+        idx = line.find(_MARKER_PREFIX)
+        if idx != -1:
+            message = line[idx + len(_MARKER_PREFIX):]
+            words = message.split(None, 1)
+            entry = self._received_markers.get(words[0]) if words else None
+            if entry and message.startswith(entry[0]):
+                entry[1](line)
+        elif self.getM593 and "M593" in line:
+            match = _RE_M593.search(line)
+            if match:
+                self._on_m593_report(match)
+        return line
 
-        # Extract the shaper values from the line
-        match_x = re.match(r".*M593 X F([\d.]+) D([\d.]+)", line)
-        match_y = re.match(r".*M593 Y F([\d.]+) D([\d.]+)", line)
+    def _on_store_shapers(self, line) -> None:
+        """Start collecting the M593 report that follows the store marker."""
 
-        if match_x and self.getM593:
-            self._plugin_logger.info("Detected M593: X value")
-            self.shapers["X"] = {
-                "F": float(match_x.group(1)),
-                "D": float(match_x.group(2))
-            }
-        if match_y and self.getM593:
-            self._plugin_logger.info("Detected M593: Y value")
-            self.shapers["Y"] = {
-                "F": float(match_y.group(1)),
-                "D": float(match_y.group(2))
-            }
-            # Save to file
-            shaper_bck_path = os.path.join(
-                self.metadata_dir, "current_shaper_values.json"
-            )
-            with open(shaper_bck_path, "w", encoding="utf-8") as f:
-                json.dump(self.shapers, f)
-            self._plugin_logger.info(f"Shaper backup saved: {self.shapers}")
+        self._plugin_logger.info("Detected M118: Store shapers message")
+        self.getM593 = True
+        self.shapers = {}
+
+    def _on_m593_report(self, match) -> None:
+        """Record one axis of the M593 report and back it up once Y arrives."""
+
+        axis = match.group(1)
+        self._plugin_logger.info("Detected M593: %s value", axis)
+        self.shapers[axis] = {
+            "F": float(match.group(2)),
+            "D": float(match.group(3))
+        }
+        if axis == "Y":
+            # Save to file, unless it already holds exactly these values
+            new_bytes = json.dumps(self.shapers, separators=(",", ":")).encode("utf-8")
+            if new_bytes != self._last_shaper_bytes:
+                shaper_bck_path = os.path.join(
+                    self.metadata_dir, "current_shaper_values.json"
+                )
+                # Write to a temp file and swap it in so a crash never leaves a truncated backup
+                tmp_path = shaper_bck_path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(new_bytes)
+                os.replace(tmp_path, shaper_bck_path)
+                self._last_shaper_bytes = new_bytes
+                self._plugin_logger.info("Shaper backup saved: %s", self.shapers)
+            else:
+                self._plugin_logger.info("Shaper backup unchanged: %s", self.shapers)
             self.getM593 = False
+            self._m593_ready.set()
 
-        elif "Pinput_Shaping: Resonance Test complete" in line:
-            self._plugin_logger.info("Detected M118: Resonance Test complete message")
-            self._plugin_logger.info(
-                f"Resonance Test complete for {self.currentAxis} axis"
-            )
-            self._plugin_logger.info("Stopping accelerometer capture...")
-            threading.Thread(target=self._stop_accelerometer_capture).start()
-            self._plugin_logger.info("Starting Input Shaping analysis...")
-            self._plugin_manager.send_plugin_message(
-                self._identifier,
-                {"type": "popup", "message": "Starting Input Shaping analysis..."},
-            )
-            self.accelerometer_capture_active = False
-            time.sleep(3)
-            self.get_input_shaping_results()
+    def _on_resonance_complete(self, line) -> None:
+        """Stop the capture and queue the analysis once the resonance sweep is done."""
 
-        elif "Pinput_Shaping: Finish Test Sweep" in line:
-            self._plugin_logger.info(
-                f"Detected M118: Finished Test Sweep for {self.currentAxis} axis"
-            )
-            self._plugin_manager.send_plugin_message(
-                self._identifier, dict(type="close_popup")
-            )
+        self._plugin_logger.info("Detected M118: Resonance Test complete message")
+        self._active = False
+        # A late M593 report could still be backed up during the sweep, stop listening now
+        self.getM593 = False
+        self._plugin_logger.info(
+            "Resonance Test complete for %s axis", self.currentAxis
+        )
+        self._plugin_logger.info("Stopping accelerometer capture...")
+        # The analysis worker runs jobs in order, so the analysis only starts
+        # once the capture tool has confirmed the CSV was saved
+        self._analysis_pool.submit(self._stop_accelerometer_capture).add_done_callback(
+            self._log_worker_exception
+        )
+        self._plugin_logger.info("Starting Input Shaping analysis...")
+        self._plugin_manager.send_plugin_message(
+            self._identifier,
+            {"type": "popup", "message": "Starting Input Shaping analysis..."},
+        )
+        self.accelerometer_capture_active = False
+        self._analysis_pool.submit(self.get_input_shaping_results).add_done_callback(
+            self._log_worker_exception
+        )
 
-        elif "Pinput_Shaping: Accelerometer|ON" in line:
-            self._plugin_logger.info("Detected M118: Start accelerometer capture")
-            self._plugin_logger.info("Accelerometer capture started...")
-            self.accelerometer_capture_active = True
-            threading.Thread(target=self._start_accelerometer_capture(3200)).start()
-        return line
+    def _on_finish_sweep(self, line) -> None:
+        """Close the progress popup once the axis sweep is done."""
+
+        self._plugin_logger.info(
+            "Detected M118: Finished Test Sweep for %s axis", self.currentAxis
+        )
+        self._active = False
+        self._plugin_manager.send_plugin_message(
+            self._identifier, dict(type="close_popup")
+        )
+
+    def _on_accelerometer_on(self, line) -> None:
+        """Start the accelerometer capture requested by the resonance sweep."""
+
+        self._plugin_logger.info("Detected M118: Start accelerometer capture")
+        self._plugin_logger.info("Accelerometer capture started...")
+        self.accelerometer_capture_active = True
+        threading.Thread(target=self._start_accelerometer_capture, args=(3200,)).start()
+
+    def _log_worker_exception(self, future) -> None:
+        """Log errors raised by jobs running on the analysis worker."""
+
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is not None:
+            self._plugin_logger.error("Background job failed: %s", exc, exc_info=exc)
 
     def restore_shapers(self) -> None:
         """Restore the saved shaper values from the backup file."""
@@ -530,23 +753,23 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
             return
 
         with open(backup_path, "r", encoding="utf-8") as f:
-            shapers = json.load(f)
-
-        for axis, settings in shapers.items():
-            freq = settings.get("F")
-            damp = settings.get("D")
-            if freq is not None and damp is not None:
-                cmd = f"M593 {axis} F{freq:.2f} D{damp} "
-                self._printer.commands(cmd)
-                self._plugin_logger.info(f"Restored: {cmd}")
+            shapers = json.loads(f.read())
+
+        cmds = [
+            f"M593 {axis} F{settings['F']:g} D{settings['D']:g}"
+            for axis, settings in shapers.items()
+            if settings.get("F") is not None and settings.get("D") is not None
+        ]
+        self._printer.commands(cmds)
+        for cmd in cmds:
+            self._plugin_logger.info("Restored: %s", cmd)
         self._plugin_logger.info("Restored shaper values to printer.")
 
     def get_input_shaping_results(self) -> dict:
         """Get the Input Shaping results after accelerometer capture."""
 
         self._plugin_logger.info(
-            f"Getting Input Shaping results for {self.currentAxis} Axis..."
-        )
+            "Getting Input Shaping results for %s Axis...", self.currentAxis)
 
         if self.accelerometer_capture_active:
             self._plugin_logger.warning(
@@ -566,10 +789,11 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
             )
             return {"success": False, "error": "CSV data file not found"}
 
+        damping = float(self._settings.get(["dampingRatio"]))
         analyzer = InputShapingAnalyzer(
             self.graphs_dir,
             self.csv_filename,
-            float(self._settings.get(["dampingRatio"])),
+            damping,
             100,
             self.currentAxis,
             logger=self._plugin_logger,
@@ -579,13 +803,13 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
         command = analyzer.get_recommendation()
         data_for_plotly = analyzer.get_plotly_data()
 
-        self._plugin_logger.info(f"Best shaper for {self.currentAxis} axis: {best_shaper}")
-        self._plugin_logger.info(f"Signal graph saved to: {signal_path}")
-        self._plugin_logger.info(f"PSD graph saved to: {psd_path}")
-        self._plugin_logger.info(f"Recommended command: {command}")
+        self._plugin_logger.info("Best shaper for %s axis: %s", self.currentAxis, best_shaper)
+        self._plugin_logger.info("Signal graph saved to: %s", signal_path)
+        self._plugin_logger.info("PSD graph saved to: %s", psd_path)
+        self._plugin_logger.info("Recommended command: %s", command)
         self._plugin_logger.info("Input Shaping analysis completed.")
         self._plugin_manager.send_plugin_message(self._identifier, dict(type="close_popup"))
-        self._printer.commands(f"M117 Freq for {self.currentAxis}:{base_freq:.2f} Damp:{self._settings.get(['dampingRatio'])}")
+        self._printer.commands(f"M117 Freq for {self.currentAxis}:{base_freq:.2f} Damp:{damping}")
         self._plugin_manager.send_plugin_message(self._identifier, {
             "type": "results_ready",
             "msg": "Input Shaping analysis completed",
@@ -615,7 +839,7 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
         return {"success": True}
 
     def _start_accelerometer_capture(self, freq=3200) -> None:
-        """Start the accelerometer capture process using pexpect."""
+        """Start the accelerometer capture process on a pseudo-terminal."""
 
         wrapper = None
 
@@ -629,53 +853,130 @@ class PinputShapingPlugin(octoprint.plugin.StartupPlugin,
                 freq = 200
             else:
                 self._plugin_logger.info(
-                    f"LIS2DW sensor does not support frequency {freq}Hz. Test will run at max 1600Hz."
+                    "LIS2DW sensor does not support frequency %sHz. Test will run at max 1600Hz.", freq
                 )
                 freq = 1600
         else:
             self._plugin_logger.info("Starting ADXL345 capture...")
             wrapper = "adxl345spi"
 
-        cmd = f"sudo {wrapper} -f {freq} -s {self.csv_filename}"
+        cmd = ["sudo", wrapper, "-f", str(freq), "-s", self.csv_filename]
         logfile_path = os.path.join(os.path.dirname(self.csv_filename), "accelerometer_output.log")
 
-        try:
-            self._adchild = pexpect.spawn(cmd, timeout=600, encoding="utf-8")
-            self._adchild.logfile = open(logfile_path, "w", encoding="utf-8")
+        self._adchild_ready = threading.Event()
+        self._adchild_saved = threading.Event()
+        self._adchild_exited = threading.Event()
 
-            # Wait for the "Press Q to stop" prompt
-            self._adchild.expect("Press Q to stop", timeout=600)
-            self._plugin_logger.info("Accelerometer ready and capturing.")
-        except pexpect.TIMEOUT:
-            self._plugin_logger.error("Timed out waiting for accelerometer to start.")
-            raise
-        except pexpect.EOF:
-            self._plugin_logger.error("Accelerometer process exited early. Check logs.")
-            raise
+        try:
+            logfile = open(logfile_path, "w", encoding="utf-8")
+            # The wrappers expect a terminal, so hand them a pty instead of plain pipes
+            master_fd, slave_fd = pty.openpty()
+            try:
+                self._adchild = subprocess.Popen(
+                    cmd, stdin=slave_fd, stdout=slave_fd, stderr=slave_fd, close_fds=True
+                )
+            except Exception:
+                os.close(master_fd)
+                logfile.close()
+                raise
+            finally:
+                os.close(slave_fd)
         except Exception as e:
-            self._plugin_logger.error(f"Unexpected error: {e}")
+            self._plugin_logger.error("Unexpected error: %s", e)
             raise
+        self._adchild_fd = master_fd
+        # The reader owns the fd and the log file from here on and closes both at EOF
+        self._adchild_reader = threading.Thread(
+            target=self._read_accelerometer_output, args=(master_fd, logfile), daemon=True
+        )
+        self._adchild_reader.start()
+
+        # Wait for the "Press Q to stop" prompt
+        if not self._wait_accelerometer_event(self._adchild_ready, 600):
+            if self._adchild_exited.is_set():
+                self._plugin_logger.error("Accelerometer process exited early. Check logs.")
+                raise RuntimeError("Accelerometer process exited early")
+            self._plugin_logger.error("Timed out waiting for accelerometer to start.")
+            raise TimeoutError("Timed out waiting for accelerometer to start")
+        self._plugin_logger.info("Accelerometer ready and capturing.")
+
+    def _read_accelerometer_output(self, fd, logfile) -> None:
+        """Copy the capture process output to its log file and flag the prompts we wait on.
+        Closes the pty and the log file once the process side of the pty is gone.
+        """
+
+        tail = ""
+        try:
+            while True:
+                try:
+                    chunk = os.read(fd, 4096)
+                except OSError:
+                    # EIO once the process exits and the pty is closed
+                    chunk = b""
+                if not chunk:
+                    break
+                text = chunk.decode("utf-8", errors="replace")
+                logfile.write(text)
+                # Keep a short tail so prompts split across two reads still match
+                tail = tail[-256:] + text
+                if "Press Q to stop" in tail:
+                    self._adchild_ready.set()
+                if _RE_SAVED.search(tail):
+                    self._adchild_saved.set()
+        finally:
+            logfile.close()
+            os.close(fd)
+            self._adchild_exited.set()
+
+    def _wait_accelerometer_event(self, event, timeout) -> bool:
+        """Wait for an output event, giving up early if the capture process exits."""
+
+        deadline = time.monotonic() + timeout
+        while not event.wait(timeout=0.5):
+            if self._adchild_exited.is_set() or time.monotonic() > deadline:
+                return event.is_set()
+        return True
 
     def _stop_accelerometer_capture(self) -> None:
         """Stop the accelerometer capture process and save the data."""
 
         self._plugin_logger.info("Stopping accelerometer capture...")
-        if self._adchild and self._adchild.isalive():
+        if self._adchild and self._adchild.poll() is None:
             try:
-                self._adchild.sendline("Q")
-                self._adchild.expect("Saved .* samples", timeout=30)
-                self._plugin_logger.info("Accelerometer confirmed data saved.")
-            except pexpect.TIMEOUT:
-                self._plugin_logger.warning("No save confirmation. Terminating...")
-                self._adchild.terminate(force=True)
-            except pexpect.EOF:
-                self._plugin_logger.info("Process already exited.")
-            finally:
-                if self._adchild.logfile:
-                    self._adchild.logfile.close()
+                os.write(self._adchild_fd, b"Q\n")
+                if self._wait_accelerometer_event(self._adchild_saved, 30):
+                    self._plugin_logger.info("Accelerometer confirmed data saved.")
+                elif self._adchild_exited.is_set():
+                    self._plugin_logger.info("Process already exited.")
+                else:
+                    self._plugin_logger.warning("No save confirmation. Terminating...")
+                    self._terminate_accelerometer_process()
+            except OSError as e:
+                self._plugin_logger.warning("Could not stop accelerometer process: %s", e)
+                self._terminate_accelerometer_process()
         else:
             self._plugin_logger.warning("Process not alive.")
 
+        # The reader closes the pty and the log file once it sees EOF
+        if self._adchild_reader is not None:
+            self._adchild_reader.join(timeout=5)
+            if self._adchild_reader.is_alive():
+                self._plugin_logger.warning("Accelerometer output still open, leaving it to its reader.")
+
+    def _terminate_accelerometer_process(self) -> None:
+        """Stop the capture process, SIGTERM first so sudo forwards it to the sensor tool."""
+
+        if self._adchild.poll() is not None:
+            return
+        self._adchild.terminate()
+        try:
+            self._adchild.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            # Last resort, sudo can't forward SIGKILL so its child may survive this
+            self._plugin_logger.warning("Accelerometer process ignored SIGTERM. Killing...")
+            self._adchild.kill()
+            self._adchild.wait()
+
     def get_update_information(self) -> dict:
         """Return the update information for the plugin."""
 
@@ -1,14 +1,50 @@
 """Input Shaping Analyzer for OctoPrint Plugin Pinput_Shaping"""
 
 import logging
+import math
 import os
 
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
+from scipy.fft import next_fast_len
 from scipy.signal import butter, filtfilt, welch
 
 MAX_BYTES_32 = 2_000_000_000  # ~ 2 gi b
+MAX_PLOT_POINTS = 4000  # upper bound of points per trace on the signal graph
+PSD_PLOT_MAX_FREQ = 200  # Hz, right edge of the PSD graph
+
+
+def _binomial_shaper(t, K, n) -> list:
+    """Impulses k*t with weights C(n, k)·K^k, normalised by their sum (1 + K)^n."""
+
+    norm = (1 + K) ** n
+    return [(k * t, math.comb(n, k) * K**k / norm) for k in range(n + 1)]
+
+
+def load_csv_columns(csv_path, columns) -> np.ndarray:
+    """Loads the named columns of a CSV file into a (rows, len(columns)) array.
+
+    Rows that can't be parsed, e.g. the last one when the capture was stopped mid-write,
+    are dropped.
+    """
+
+    with open(csv_path, encoding="utf-8") as f:
+        header = [c.strip().lower() for c in f.readline().split(",")]
+    for col in columns:
+        if col not in header:
+            raise ValueError(f"Column '{col}' not found in CSV")
+    usecols = [header.index(col) for col in columns]
+
+    try:
+        data = np.loadtxt(csv_path, delimiter=",", skiprows=1, usecols=usecols, ndmin=2)
+    except ValueError:
+        data = np.genfromtxt(
+            csv_path, delimiter=",", skip_header=1, usecols=usecols,
+            invalid_raise=False, ndmin=2,
+        )
+    # A header-only file loads as an empty array of the wrong width
+    data = data.reshape(-1, len(usecols))
+    return data[np.isfinite(data).all(axis=1)]
 
 
 class InputShapingAnalyzer:
@@ -37,6 +73,8 @@ class InputShapingAnalyzer:
         )
         self.csv_path = csv_path
         self.damping = damping
+        # Residual vibration ratio of one half period, only depends on the damping
+        self._K = np.exp(-damping * np.pi / np.sqrt(1 - damping**2))
         self.cutoff_freq = cutoff_freq
         self.axis = axis.upper()
         self.result_dir = save_dir
@@ -47,6 +85,7 @@ class InputShapingAnalyzer:
         self.raw = None
         self.filtered = None
         self.sampling_rate = None
+        self._dt = None  # sample period, set together with sampling_rate
         self.freqs = None
         self.psd = None
 
@@ -54,27 +93,25 @@ class InputShapingAnalyzer:
         """Loads the data from the CSV file and processes it."""
 
         self._plugin_logger.info(
-            f"Loading data from CSV file {self.csv_path} for axis {self.axis}"
-        )
-        df = pd.read_csv(self.csv_path)
-        df.columns = [c.strip().lower() for c in df.columns]
-
-        # Time
-        df["time"] = pd.to_numeric(df["time"], errors="coerce")
-        df = df.dropna(subset=["time"])
-
-        # selected axis
+            "Loading data from CSV file %s for axis %s", self.csv_path, self.axis)
         axis_col = self.axis.lower()  # "x" o "y" o "z"
-        if axis_col not in df.columns:
-            raise ValueError(f"Column '{axis_col}' not found in CSV")
+        data = load_csv_columns(self.csv_path, ("time", axis_col))
+
+        self.time = data[:, 0]
+        self.raw = data[:, 1]
 
-        df[axis_col] = pd.to_numeric(df[axis_col], errors="coerce")
-        df = df.dropna(subset=[axis_col])
+        self._set_sample_period()
 
-        self.time = df["time"].to_numpy(dtype=np.float64)
-        self.raw = df[axis_col].to_numpy(dtype=np.float64)
+    def _set_sample_period(self) -> None:
+        """Sets the mean sample period and sampling rate from the loaded time base."""
 
-        self.sampling_rate = 1.0 / np.mean(np.diff(self.time))
+        # The mean of the diffs telescopes to the end points, no need for an N-long diff
+        self._dt = float(self.time[-1] - self.time[0]) / (len(self.time) - 1)
+        self.sampling_rate = 1.0 / self._dt
+        if self._plugin_logger.isEnabledFor(logging.DEBUG):
+            jitter = np.max(np.abs(np.diff(self.time) - self._dt))
+            self._plugin_logger.debug(
+                "Sampling rate %.3f Hz, max period jitter %.3g s", self.sampling_rate, jitter)
 
     def lowpass_filter(self, data, order=4) -> np.ndarray:
         """Applies a low-pass Butterworth filter to the data.
@@ -87,12 +124,11 @@ class InputShapingAnalyzer:
         cutoff = min(self.cutoff_freq, nyq * 0.99)
         norm_cutoff = cutoff / nyq
         self._plugin_logger.info(
-            f"lowpass_filter: cutoff={cutoff}, nyq={nyq}, norm_cutoff={norm_cutoff}, sampling_rate={self.sampling_rate}"
-        )
+            "lowpass_filter: cutoff=%s, nyq=%s, norm_cutoff=%s, sampling_rate=%s",
+            cutoff, nyq, norm_cutoff, self.sampling_rate)
         if not (0 < norm_cutoff < 1):
             self._plugin_logger.error(
-                f"Invalid norm_cutoff: {norm_cutoff} (cutoff={cutoff}, nyq={nyq})"
-            )
+                "Invalid norm_cutoff: %s (cutoff=%s, nyq=%s)", norm_cutoff, cutoff, nyq)
             raise ValueError(
                 f"Digital filter critical frequencies must be 0 < Wn < 1 (got {norm_cutoff}, cutoff={cutoff}, nyq={nyq})"
             )
@@ -103,11 +139,11 @@ class InputShapingAnalyzer:
         """Generates input shapers based on the given frequency."""
 
         t = 1 / freq
-        K = np.exp(-self.damping * np.pi / np.sqrt(1 - self.damping**2))
+        K = self._K
         shapers = {}
 
         # Zero Vibration (ZV)
-        shapers["ZV"] = [(0, 1 / (1 + K)), (t, K / (1 + K))]
+        shapers["ZV"] = _binomial_shaper(t, K, 1)
 
         # Modified ZV (MFA)
         shapers["MZV"] = [
@@ -117,44 +153,28 @@ class InputShapingAnalyzer:
         ]
 
         # Extra insensitive (her)
-        shapers["EI"] = [
-            (0,   1 / (1 + 3*K + 3*K**2 + K**3)),
-            (t,   3*K / (1 + 3*K + 3*K**2 + K**3)),
-            (2*t, 3*K**2 / (1 + 3*K + 3*K**2 + K**3)),
-            (3*t, K**3 / (1 + 3*K + 3*K**2 + K**3)),
-        ]
+        shapers["EI"] = _binomial_shaper(t, K, 3)
 
         # 2-Hump no
-        shapers["2HUMP_EI"] = [
-            (0,   1 / (1 + 4*K + 6*K**2 + 4*K**3 + K**4)),
-            (t,   4*K / (1 + 4*K + 6*K**2 + 4*K**3 + K**4)),
-            (2*t, 6*K**2 / (1 + 4*K + 6*K**2 + 4*K**3 + K**4)),
-            (3*t, 4*K**3 / (1 + 4*K + 6*K**2 + 4*K**3 + K**4)),
-            (4*t, K**4 / (1 + 4*K + 6*K**2 + 4*K**3 + K**4)),
-        ]
+        shapers["2HUMP_EI"] = _binomial_shaper(t, K, 4)
 
         # 3-Hump no
-        shapers["3HUMP_EI"] = [
-            (0,   1 / (1 + 6*K + 15*K**2 + 20*K**3 + 15*K**4 + 6*K**5 + K**6)),
-            (t,   6*K / (1 + 6*K + 15*K**2 + 20*K**3 + 15*K**4 + 6*K**5 + K**6)),
-            (2*t, 15*K**2 / (1 + 6*K + 15*K**2 + 20*K**3 + 15*K**4 + 6*K**5 + K**6)),
-            (3*t, 20*K**3 / (1 + 6*K + 15*K**2 + 20*K**3 + 15*K**4 + 6*K**5 + K**6)),
-            (4*t, 15*K**4 / (1 + 6*K + 15*K**2 + 20*K**3 + 15*K**4 + 6*K**5 + K**6)),
-            (5*t, 6*K**5 / (1 + 6*K + 15*K**2 + 20*K**3 + 15*K**4 + 6*K**5 + K**6)),
-            (6*t, K**6 / (1 + 6*K + 15*K**2 + 20*K**3 + 15*K**4 + 6*K**5 + K**6)),
-        ]
+        shapers["3HUMP_EI"] = _binomial_shaper(t, K, 6)
 
         return shapers
 
-    def apply_shaper(self, signal, time, shaper) -> np.ndarray:
+    def apply_shaper(self, signal, time, shaper, dt=None) -> np.ndarray:
         """Applies the input shaper to the signal.
         :param signal: The input signal to shape.
         :param time: The time vector corresponding to the signal.
         :param shaper: The input shaper to apply, defined as a list of (delay, amplitude) tuples.
+        :param dt: Sample period of time, computed from it if omitted.
         :return: The shaped signal.
         """
 
-        dt = np.mean(np.diff(time))
+        # A handful of sparse taps: shifted adds beat an FFT convolution here
+        if dt is None:
+            dt = np.mean(np.diff(time))
         n = len(signal)
         shaped = np.zeros(n)
         for delay, amp in shaper:
@@ -163,6 +183,19 @@ class InputShapingAnalyzer:
                 shaped[shift:] += amp * signal[: n - shift]
         return shaped
 
+    def shaper_gain(self, shaper, freqs, dt) -> np.ndarray:
+        """Power gain |H(f)|² of the input shaper, with delays rounded to samples like apply_shaper.
+        :param shaper: The input shaper, defined as a list of (delay, amplitude) tuples.
+        :param freqs: The frequencies to evaluate the gain at.
+        :param dt: Sample period of the signal the shaper is applied to.
+        :return: The power gain at each frequency.
+        """
+
+        response = np.zeros(len(freqs), dtype=complex)
+        for delay, amp in shaper:
+            response += amp * np.exp(-2j * np.pi * freqs * (np.round(delay / dt) * dt))
+        return np.abs(response) ** 2
+
     def compute_psd(self, signal: np.ndarray) -> tuple:
         """Computes the Power Spectral Density (PSD) of the signal using Welch's method.
         :param signal: The input signal to analyze.
@@ -172,21 +205,20 @@ class InputShapingAnalyzer:
         # Adaptive Welch that guarantees not exceeding the limit of 2 gib.
         sig = signal.astype(np.float32, copy=False)
 
-        # starting point
+        # starting point, snapped to a length the FFT handles fastest (2^a·3^b·5^c)
         nperseg = min(4096, len(sig) // 8)
-        nperseg = max(nperseg, 256)
+        nperseg = next_fast_len(max(nperseg, 256))
 
         while True:
             n_win = len(sig) - nperseg + 1
             est_mem = n_win * nperseg * sig.itemsize
             if est_mem < MAX_BYTES_32 or nperseg <= 256:
                 break
-            nperseg //= 2  # reduces half and try again
+            nperseg = next_fast_len(nperseg // 2)  # reduces half and try again
 
         self._plugin_logger.debug(
-            f"Welch: nperseg={nperseg}, windows={n_win}, "
-            f"est_mem={est_mem / 1e6:.1f} MB, len={len(sig)}"
-        )
+            "Welch: nperseg=%s, windows=%s, est_mem=%.1f MB, len=%s",
+            nperseg, n_win, est_mem / 1e6, len(sig))
 
         return welch(sig, fs=self.sampling_rate, nperseg=nperseg)
 
@@ -197,19 +229,25 @@ class InputShapingAnalyzer:
         try:
             self.filtered = self.lowpass_filter(self.raw)
         except ValueError as e:
-            self._plugin_logger.error(f"Lowpass filter failed: {e}")
+            self._plugin_logger.error("Lowpass filter failed: %s", e)
             raise
         self.freqs, self.psd = self.compute_psd(self.filtered)
 
-        freq_range = (self.freqs > 20) & (self.freqs < 80)
-        self.base_freq = self.freqs[freq_range][np.argmax(self.psd[freq_range])]
+        # 20 < f < 80 Hz as a contiguous slice of the sorted frequency axis
+        lo = np.searchsorted(self.freqs, 20, side="right")
+        hi = np.searchsorted(self.freqs, 80, side="left")
+        self.base_freq = float(self.freqs[lo + np.argmax(self.psd[lo:hi])])
         shapers = self.generate_shapers(self.base_freq)
 
+        dt = self._dt
+        # Residual vibration is judged over the band that is graphed, not up to Nyquist
+        band = (self.freqs > 0) & (self.freqs < PSD_PLOT_MAX_FREQ)
         for name, shaper in shapers.items():
-            shaped = self.apply_shaper(self.filtered, self.time, shaper)
-            _, shaped_psd = self.compute_psd(shaped)
-            vibr = np.sum(shaped_psd)
-            accel = max(np.abs(np.gradient(shaped, np.mean(np.diff(self.time)))))
+            # Shaping is linear and time invariant: its PSD is the original one times |H(f)|²
+            shaped_psd = (self.psd * self.shaper_gain(shaper, self.freqs, dt)).astype(self.psd.dtype)
+            vibr = np.sum(shaped_psd[band])
+            shaped = self.apply_shaper(self.filtered, self.time, shaper, dt)
+            accel = float(np.abs(np.gradient(shaped, dt)).max())
             self.shaper_results[name] = {
                 "psd": shaped_psd,
                 "vibr": vibr,
@@ -221,6 +259,11 @@ class InputShapingAnalyzer:
         )
         return self.best_shaper
 
+    def _plotted_bins(self) -> int:
+        """Number of PSD bins up to PSD_PLOT_MAX_FREQ, plus one so a line reaches the graph edge."""
+
+        return min(len(self.freqs), int(np.searchsorted(self.freqs, PSD_PLOT_MAX_FREQ)) + 1)
+
     def generate_graphs(self) -> tuple:
         """Generates graphs for the original and filtered signals, and the PSD with input shapers.
         :return: A tuple containing the paths to the generated graphs and the shaper results.
@@ -229,19 +272,20 @@ class InputShapingAnalyzer:
         # get the date from csv file which format is Raw_accel_values_AXIS_X_20250416T133919.csv
         date = os.path.basename(self.csv_path).split("_")[-1].split(".")[0]
 
-        # Signal Graph
+        # Signal Graph, every 50th sample but never more than MAX_PLOT_POINTS per trace
         signal_path = os.path.join(self.result_dir, f"{self.axis}_signal_{date}.png")
+        step = max(50, -(-len(self.time) // MAX_PLOT_POINTS))
         plt.figure(figsize=(14, 5))
         plt.plot(
-            self.time[::50],
-            self.raw[::50],
+            self.time[::step],
+            self.raw[::step],
             label="Original",
             alpha=0.4,
             color="#007bff",
         )
         plt.plot(
-            self.time[::50],
-            self.filtered[::50],
+            self.time[::step],
+            self.filtered[::step],
             label="Filtered",
             linewidth=2.0,
             color="#ff7f0e",
@@ -258,7 +302,9 @@ class InputShapingAnalyzer:
         # PSD Graph
         psd_path = os.path.join(self.result_dir, f"{self.axis}_psd_{date}.png")
         fig, ax = plt.subplots(figsize=(14, 6))
-        ax.plot(self.freqs, self.psd, label="Original", color="black", linewidth=1.5)
+        # Only hand matplotlib the bins that end up inside the x limits
+        shown = self._plotted_bins()
+        ax.plot(self.freqs[:shown], self.psd[:shown], label="Original", color="black", linewidth=1.5)
 
         for name, result in self.shaper_results.items():
             label = (
@@ -267,14 +313,14 @@ class InputShapingAnalyzer:
                 f"accel={result['accel']:.1f}"
             )
             ax.plot(
-                self.freqs, result["psd"], linestyle="--", linewidth=1.2, label=label
+                self.freqs[:shown], result["psd"][:shown], linestyle="--", linewidth=1.2, label=label
             )
 
         ax.set_title(f"PSD with Input Shapers - Axis {self.axis}", fontsize=14)
         ax.set_xlabel("Frequency (Hz)")
         ax.set_ylabel("Power Spectral Density (PSD)")
         ax.grid(True, linestyle="--", alpha=0.4)
-        ax.set_xlim(0, 200)
+        ax.set_xlim(0, PSD_PLOT_MAX_FREQ)
         ax.set_ylim(0, np.max(self.psd) * 1.1)
         ax.legend(loc="upper right", fontsize=8)
         # Adjust lower space
@@ -314,39 +360,20 @@ class InputShapingAnalyzer:
 
         return f"M593 F{self.base_freq:.1f} D{self.damping} S{self.best_shaper}"
 
-    # def get_plotly_data(self):
-    #     data = {
-    #         "time": self.time[::5].tolist(),  # reduces size if necessary
-    #         "raw": self.raw[::5].tolist(),
-    #         "filtered": self.filtered[::5].tolist(),
-    #         "freqs": self.freqs.tolist(),
-    #         "psd_original": self.psd.tolist(),
-    #         "shapers": {},
-    #         "base_freq": round(self.base_freq, 2),
-    #         "best_shaper": self.best_shaper
-    #     }
-
-    #     for name, result in self.shaper_results.items():
-    #         data["shapers"][name] = {
-    #             "psd": result["psd"].tolist(),
-    #             "vibr": round(result["vibr"], 3),
-    #             "accel": round(result["accel"], 2)
-    #         }
-
-    #     return data
-
     def get_plotly_data(self) -> dict:
         """Generates data for Plotly visualization."""
 
+        # Spectra are cut to the band the PSD graph shows, above it there is only filter residue
+        shown = self._plotted_bins()
         return {
-            "time": [float(t) for t in self.time[::5]],
-            "raw": [float(r) for r in self.raw[::5]],
-            "filtered": [float(f) for f in self.filtered[::5]],
-            "freqs": [float(f) for f in self.freqs],
-            "psd_original": [float(p) for p in self.psd],
+            "time": self.time[::5].tolist(),
+            "raw": self.raw[::5].tolist(),
+            "filtered": self.filtered[::5].tolist(),
+            "freqs": self.freqs[:shown].tolist(),
+            "psd_original": self.psd[:shown].tolist(),
             "shapers": {
                 name: {
-                    "psd": [float(p) for p in result["psd"]],
+                    "psd": result["psd"][:shown].tolist(),
                     "vibr": round(float(result["vibr"]), 3),
                     "accel": round(float(result["accel"]), 2),
                 }
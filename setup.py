@@ -33,7 +33,7 @@ plugin_url = "https://github.com/navaismo/OctoPrint-Pinput_Shaping"
 plugin_license = "AGPLv3"
 
 # Any additional requirements besides OctoPrint should be listed here
-plugin_requires = ["numpy==2.0.2", "scipy==1.13.1", "matplotlib==3.9.4", "pandas==2.3.0", "pexpect"]
+plugin_requires = ["numpy==2.0.2", "scipy==1.13.1", "matplotlib==3.9.4"]
 
 ### --------------------------------------------------------------------------------------------------------------------
 ### More advanced options that you usually shouldn't have to touch follow after this point